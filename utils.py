@@ -1,5 +1,33 @@
+from collections import OrderedDict
+import math
 import numpy as np
 import pandas as pd
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# kept as plain Python: on Python floats it is as fast as a jitted call,
+# without the numba compile or cache files
+def _welford_scalar(n, M, S, x):
+    n += 1
+    d = x - M
+    M += d / n
+    S += (x - M) * d
+    var = S / (n - 1) if n > 1 else M * M
+    std = math.sqrt(var)
+    return n, M, S, var, std, 1.0 / (std + 1e-8)
+
+def _zfilter_batch(X, mean, inv_std, shift, clip):
+    # y = (x-mean)*inv_std+shift, clipped, written back into X row by row
+    for i in prange(X.shape[0]):
+        for j in range(X.shape[1]):
+            y = (X[i, j] - mean[j]) * inv_std[j] + shift[j]
+            X[i, j] = min(max(y, -clip), clip)
+    return X
+
+if njit is not None:
+    _zfilter_batch = njit(parallel=True, cache=True)(_zfilter_batch)
 
 class RunningStat(object):
     '''
@@ -12,16 +40,64 @@ class RunningStat(object):
         self._n = 0
         self._M = np.zeros(shape)
         self._S = np.zeros(shape)
+        # scratch buffers reused by push to avoid per-sample allocations
+        self._d1 = np.empty(shape)
+        self._d2 = np.empty(shape)
+        # scalar streams (e.g. rewards) use Python float arithmetic
+        self._scalar = self._M.shape == ()
+        # scalar streams keep var/std/inv_std as Python floats updated on
+        # every push; vector streams compute inv_std on the first read after
+        # a push (None marks it stale)
+        self._refresh()
+    def _refresh(self):
+        if self._scalar:
+            M, S = float(self._M), float(self._S)
+            self._var = S / (self._n - 1) if self._n > 1 else M * M
+            self._std = math.sqrt(self._var)
+            self._inv_std = 1.0 / (self._std + 1e-8)
+        else:
+            self._inv_std = None
     def push(self, x):
+        if self._scalar:
+            # getattr avoids np.ndim's asarray cost on plain Python numbers
+            assert getattr(x, 'ndim', 0) == 0,(np.shape(x),())
+            (self._n, M, S, self._var, self._std,
+             self._inv_std) = _welford_scalar(self._n, float(self._M), float(self._S), float(x))
+            self._M[...] = M
+            self._S[...] = S
+            return
         x = np.asarray(x)
         assert x.shape == self._M.shape,(x.shape,self._M.shape)
         self._n += 1
         if self._n == 1:
             self._M[...] = x
         else:
-            oldM = self._M.copy()
-            self._M[...] = oldM + (x - oldM) / self._n
-            self._S[...] = self._S + (x - oldM) * (x - self._M)
+            np.subtract(x, self._M, out=self._d1)
+            np.divide(self._d1, self._n, out=self._d2)
+            self._M += self._d2
+            np.subtract(x, self._M, out=self._d2)
+            np.multiply(self._d1, self._d2, out=self._d1)
+            self._S += self._d1
+        self._inv_std = None
+    def push_batch(self, x):
+        '''
+        Push a batch of samples stacked along axis 0, merging its
+        moments with Chan et al.'s parallel update.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        assert x.shape[1:] == self._M.shape,(x.shape,self._M.shape)
+        n_b = x.shape[0]
+        if n_b == 0:
+            return
+        mean_b = x.mean(axis=0)
+        d = x - mean_b
+        S_b = np.square(d, out=d).sum(axis=0)
+        n = self._n + n_b
+        delta = mean_b - self._M
+        self._M += delta * (n_b / n)
+        self._S += S_b + np.square(delta) * (self._n * n_b / n)
+        self._n = n
+        self._refresh()
     @property
     def n(self):
         return self._n
@@ -30,11 +106,21 @@ class RunningStat(object):
         return self._M
     @property
     def var(self):
+        if self._scalar:
+            return self._var
         return self._S / (self._n - 1) if self._n > 1 else np.square(self._M)
     @property
     def std(self):
+        if self._scalar:
+            return self._std
         return np.sqrt(self.var)
     @property
+    def inv_std(self):
+        '''1/(std+1e-8), cached until the next push'''
+        if self._inv_std is None:
+            self._inv_std = 1.0 / (self.std + 1e-8)
+        return self._inv_std
+    @property
     def shape(self):
         return self._M.shape
 
@@ -50,9 +136,11 @@ class ZFilter:
         self.clip = clip
         self.shape = shape
         self.rs = RunningStat(self.shape)
+        self._scalar = self.rs.shape == ()
         self.gamma=gamma
         if gamma:
             self.ret = np.zeros(shape)
+        self._out = np.empty(shape)
 
         
         # self.prev_filter = prev_filter
@@ -65,19 +153,74 @@ class ZFilter:
             self.rs.push(self.ret)
         else:
             self.rs.push(x)
-        if self.center:
-            x = x - self.rs.mean
+        if self._scalar:
+            # rewards: float arithmetic is cheaper than 0-d ufuncs
+            y = float(x)
+            mean = float(self.rs.mean)
+            if self.scale:
+                # (x-mean)/std, plus the mean back when not centering
+                y = (y - mean) * self.rs.inv_std + (0.0 if self.center else mean)
+            elif self.center:
+                y -= mean
+            if self.clip:
+                y = min(max(y, -self.clip), self.clip)
+            return np.float64(y)
+        mean = self.rs.mean
+        out = self._out
         if self.scale:
+            inv_std = self.rs.inv_std
             if self.center:
-                x = x / (self.rs.std + 1e-8)
+                np.subtract(x, mean, out=out)
+                out *= inv_std
             else:
-                diff = x - self.rs.mean
-                diff = diff/(self.rs.std + 1e-8)
-                x = diff + self.rs.mean
-                # x = x/(self.rs.std + 1e-8)
+                # (x-mean)/std + mean
+                np.multiply(x, inv_std, out=out)
+                out += mean * (1 - inv_std)
+        elif self.center:
+            np.subtract(x, mean, out=out)
+        else:
+            out[...] = x
         if self.clip:
-            x = np.clip(x, -self.clip, self.clip)
-        return x
+            np.clip(out, -self.clip, self.clip, out=out)
+        # out is reused by the next call, so hand back a copy
+        return out.copy()
+
+    def push_batch(self, X):
+        '''
+        Update the running statistics with a batch of samples (axis 0)
+        without filtering them, e.g. to warm-start from a replay buffer.
+        '''
+        if self.gamma:
+            X = np.asarray(X, dtype=np.float64)
+            rets = np.empty_like(X)
+            for i, x in enumerate(X):
+                self.ret = self.ret * self.gamma + x
+                rets[i] = self.ret
+            X = rets
+        self.rs.push_batch(X)
+
+    def apply_batch(self, X):
+        '''
+        Push a batch of samples (axis 0) and return them filtered with
+        the updated statistics, e.g. to normalize a whole replay buffer.
+        '''
+        self.push_batch(X)
+        X = np.array(X, dtype=np.float64)
+        # explicit width so an empty batch reshapes too
+        flat = X.reshape(X.shape[0], int(np.prod(self.rs.shape)))
+        mean = self.rs.mean.reshape(-1)
+        inv_std = np.reshape(self.rs.inv_std, -1) if self.scale else np.ones_like(mean)
+        # center=False adds the mean back after scaling
+        shift = np.zeros_like(mean) if self.center else mean
+        clip = self.clip if self.clip else np.inf
+        if njit is not None:
+            _zfilter_batch(flat, mean, inv_std, shift, clip)
+        else:
+            np.subtract(flat, mean, out=flat)
+            flat *= inv_std
+            flat += shift
+            np.clip(flat, -clip, clip, out=flat)
+        return X
 
     def reset(self):
         # self.prev_filter.reset()
@@ -110,7 +253,7 @@ def test_r():
         print(r,rew)
 
 class NeighbourAgentBuffer(object):
-    def __init__(self,state_shape,hist_length=5,future_length=5,query_mode='full_future'):
+    def __init__(self,state_shape,hist_length=5,future_length=5,query_mode='full_future',capacity=64,max_agents=16,cache_size=256):
         self.hist_length = hist_length
         self.future_length = future_length
 
@@ -118,136 +261,195 @@ class NeighbourAgentBuffer(object):
         assert self.query_mode in {'full_future','default','history_only'}
         #full future(the neighbors must have full future length steps given current timesteps)
         #TODO:default(the neighbors must have at least 1 future step)(involves using mask in calculating loss)
-        self.buffer = dict()
         self.state_shape = state_shape
+        # per-step feature size
+        self._D = state_shape[-1]
+        # agents map to slots of one (slots,steps,dim) tensor; both axes double when full
+        self._slot_of = dict()
+        self._values = np.empty((max_agents,capacity,self._D),dtype=np.float32)
+        self._timesteps = np.empty((max_agents,capacity),dtype=np.int32)
+        # per-slot fill count and last timestep, kept as Python ints for a cheap add()
+        self._count = [0]*max_agents
+        self._last_t = [0]*max_agents
+        # LRU of recent query results. Keys carry the buffer version, which add()
+        # bumps, so only repeated identical queries between adds hit; stale
+        # entries age out instead of being cleared on every add
+        self.cache_size = cache_size
+        self._query_cache = OrderedDict()
+        self._version = 0
+
+    def _cache_get(self,key):
+        hit = self._query_cache.get(key)
+        if hit is not None:
+            self._query_cache.move_to_end(key)
+        return hit
+
+    def _cache_put(self,key,value):
+        self._query_cache[key] = value
+        if len(self._query_cache)>self.cache_size:
+            self._query_cache.popitem(last=False)
+
+    def _resize(self,num_slots,cap):
+        old_slots,old_cap = self._timesteps.shape
+        values = np.empty((num_slots,cap,self._D),dtype=np.float32)
+        values[:old_slots,:old_cap] = self._values
+        timesteps = np.empty((num_slots,cap),dtype=np.int32)
+        timesteps[:old_slots,:old_cap] = self._timesteps
+        self._count += [0]*(num_slots-old_slots)
+        self._last_t += [0]*(num_slots-old_slots)
+        self._values,self._timesteps = values,timesteps
+
+    def _slot(self,ids):
+        slot = self._slot_of.get(ids)
+        if slot is None:
+            slot = self._slot_of[ids] = len(self._slot_of)
+            num_slots,cap = self._timesteps.shape
+            if slot>=num_slots:
+                self._resize(2*num_slots,cap)
+        return slot
+
+    def _append(self,slot,values,timesteps):
+        count,num = self._count[slot],len(timesteps)
+        num_slots,cap = self._timesteps.shape
+        if count+num>cap:
+            self._resize(num_slots,max(2*cap,count+num))
+        self._values[slot,count:count+num] = values
+        self._timesteps[slot,count:count+num] = timesteps
+        self._count[slot] = count+num
+        self._last_t[slot] = int(timesteps[-1])
 
-    
     def add(self,ids,values,timesteps):
-
-        if ids not in self.buffer:
-            self.buffer[ids]={
-                'values':[],
-                'timesteps':[]
-            }
-
-        # for easier query
-        if len(self.buffer[ids]['timesteps'])>0:
-            if timesteps!=self.buffer[ids]['timesteps'][-1]+1:
-                # print(self.buffer[ids]['timesteps'][-1],timesteps)
-                id_arr = np.arange(self.buffer[ids]['timesteps'][-1],timesteps+1)
-                fp = np.array([self.buffer[ids]['values'][-1],values])
-
-                res = []
-                for i in range(fp.shape[1]):
-                    inter = np.interp(id_arr[1:-1],[id_arr[0],id_arr[-1]],fp[:,i])
-                    res.append(inter)
-                res = np.transpose(res)
-                
-                for t,v in zip(id_arr[1:-1],res):
-                    self.buffer[ids]['values'].append(v)
-                    self.buffer[ids]['timesteps'].append(t)
-                
-                # print(self.buffer[ids]['timesteps'][-1])
-
-            assert timesteps==self.buffer[ids]['timesteps'][-1]+1,('this_time steps:',timesteps,'last:',self.buffer[ids]['timesteps'][-1],ids)
-        self.buffer[ids]['values'].append(values)
-        self.buffer[ids]['timesteps'].append(timesteps)
+        self._version += 1
+
+        slot = self._slot_of.get(ids)
+        if slot is None:
+            slot = self._slot(ids)
+        count = self._count[slot]
+
+        if count>0:
+            last_t = self._last_t[slot]
+            # queries binary-search the timesteps, so they must stay sorted
+            assert timesteps>last_t,('this_time steps:',timesteps,'last:',last_t,ids)
+            # for easier query
+            if timesteps!=last_t+1:
+                # print(last_t,timesteps)
+                # linearly interpolate the missing steps between the last stored value and this one
+                gap = timesteps - last_t
+                alphas = np.arange(1,gap,dtype=np.float32)/gap
+                fp0 = self._values[slot,count-1]
+                res = fp0 + alphas[:,None]*(np.asarray(values,dtype=np.float32)-fp0)
+
+                self._append(slot,res,np.arange(last_t+1,timesteps))
+                count = self._count[slot]
+
+                # print(self._last_t[slot])
+        # contiguous step: write the single row in place
+        if count==self._timesteps.shape[1]:
+            self._resize(self._timesteps.shape[0],2*count)
+        self._values[slot,count] = values
+        self._timesteps[slot,count] = timesteps
+        self._count[slot] = count+1
+        self._last_t[slot] = timesteps
+
+    def _locate(self,slot,curr_timestep):
+        # number of stored steps at or before curr_timestep
+        count,timesteps = self._count[slot],self._timesteps[slot]
+        idx = int(curr_timestep - timesteps[0]) + 1
+        # timesteps are normally contiguous, so one compare usually suffices
+        if 0<idx<=count and timesteps[idx-1]==curr_timestep:
+            return idx
+        return int(np.searchsorted(timesteps[:count],curr_timestep,side='right'))
     
     def query_futures(self,curr_timestep,curr_ids,pad_length=10):
-
-        neighbor_val = []
-        for ids in curr_ids:
-            candidate_neighbor = self.buffer[ids]
-            hist_t,fut_t = curr_timestep - candidate_neighbor['timesteps'][0] + 1,candidate_neighbor['timesteps'][-1]-curr_timestep
-            n = max(hist_t-self.hist_length,0)
-            l = min(hist_t,self.hist_length)
-            f = min(fut_t,self.future_length)
-            fut = candidate_neighbor['values'][n+l:n+l+f]
-            fut = self.pad_fut(fut, pad_length)
-            neighbor_val.append(fut)
-        neighbor = neighbor_val 
-
-        return np.array(neighbor,dtype=np.float32)
+        key = ('futures',self._version,self.query_mode,self.hist_length,self.future_length,
+               curr_timestep,tuple(curr_ids),pad_length)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached.copy()
+
+        # wide enough for a full future even if future_length exceeds pad_length
+        width = max(pad_length,self.future_length)
+        neighbor = np.zeros((len(curr_ids),width,self._D),dtype=np.float32)
+        for i,ids in enumerate(curr_ids):
+            slot = self._slot_of[ids]
+            hist_t = self._locate(slot,curr_timestep)
+            f = min(self._count[slot]-hist_t,self.future_length)
+            # rows past f stay zero as right padding
+            neighbor[i,:f] = self._values[slot,hist_t:hist_t+f]
+        self._cache_put(key,neighbor)
+
+        return neighbor.copy()
 
     def query_neighbours(self,curr_timestep,curr_ids,curr_ind,keep_top=5,pad_length=10):
-        neighbor_val = []
+        key = ('neighbours',self._version,self.query_mode,self.hist_length,self.future_length,
+               curr_timestep,tuple(curr_ids),tuple(curr_ind),keep_top,pad_length)
+        cached = self._cache_get(key)
+        if cached is not None:
+            neighbor,buf_ind = cached
+            return neighbor.copy(),list(buf_ind)
+
+        # resolve the mode and attribute lookups once rather than per candidate
+        if self.query_mode=='history_only':
+            full_future = False
+        elif self.query_mode=='full_future':
+            full_future = True
+        else:
+            raise NotImplementedError()
+        hist_length,future_length = self.hist_length,self.future_length
+        values,counts = self._values,self._count
+
+        # history is left-padded to pad_length but never cut below hist_length
+        hist_width = max(pad_length,hist_length)
+        # unfilled rows stay zero as padding for missing neighbours
+        width = hist_width+future_length if full_future else hist_width
+        neighbor = np.zeros((keep_top,width,self._D),dtype=np.float32)
         i=0
         buf_ind=[]
         for ids,ind in zip(curr_ids,curr_ind):
-            candidate_neighbor = self.buffer[ids]
-            hist_t,fut_t = curr_timestep - candidate_neighbor['timesteps'][0] + 1,candidate_neighbor['timesteps'][-1]-curr_timestep
-            n = max(hist_t-self.hist_length,0)
-            l = min(hist_t,self.hist_length)
-            f = min(fut_t,self.future_length)
-
-            if self.query_mode=='history_only':
+            slot = self._slot_of[ids]
+            hist_t = self._locate(slot,curr_timestep)
+            fut_t = counts[slot]-hist_t
+            l = min(hist_t,hist_length)
+            n = hist_t-l
+
+            if full_future:
+                if fut_t<future_length:
+                    continue
+                # left-padded history followed by the future, in one write
+                neighbor[i,hist_width-l:] = values[slot,n:n+l+future_length]
+                i+=1
+            else:
                 if hist_t<=0:
                     continue
-                val = candidate_neighbor['values'][n:n+l]
-                # if l==1:
-                #     val = np.expand_dims(val, axis=0)
-                # print(np.array(val).shape)
-                val = self.pad_hist(val,pad_length)
-                # print(len(val),n,l)
-                neighbor_val.append(val)
+                # history right-aligned, left-padded with zeros
+                neighbor[i,hist_width-l:] = values[slot,n:n+l]
                 buf_ind.append(ind)
                 i+=1
-            elif self.query_mode=='full_future':
-                if fut_t<self.future_length:
-                    continue
-                hist = candidate_neighbor['values'][n:n+l]
-                fut = candidate_neighbor['values'][n+l:n+l+f]
-                hist = self.pad_hist(hist,pad_length)
-                neighbor_val.append(hist+fut)
-                i+=1    
-            else:
-                raise NotImplementedError()
             
             if i>=keep_top:
                 break
-        
-        pad_num = keep_top - min(len(neighbor_val),keep_top)
-
-
-        pad_val = np.zeros((np.clip(curr_timestep+1,0,self.state_shape[1]),self.state_shape[2]))
-        # print(pad_val.shape,self.state_shape,curr_timestep)
-        # print(neighbor_val[0].shape)
-
-        neighbor = neighbor_val + pad_num*[pad_val]
-
-        # print(neighbor)
 
-        return neighbor,buf_ind
+        self._cache_put(key,(neighbor,buf_ind))
 
-    def pad_fut(self,line,pad_length):
-        assert len(np.array(line).shape)==2,(line)
-        num = pad_length - min(pad_length,len(line))
-        padded = line + [[0]*len(line[-1])]*num  
-        return padded
+        return neighbor.copy(),list(buf_ind)
 
-    def pad_hist(self,line,pad_length):
-        assert len(np.array(line).shape)==2,(line)
-        num = pad_length - min(pad_length,len(line))
-        padded = [[0]*len(line[0])]*num + line      
-        return padded
-    
     def clear(self):
-        self.buffer = dict()
+        self._slot_of = dict()
+        self._count = [0]*len(self._count)
+        self._version += 1
+        self._query_cache.clear()
 
 def split_future(egos,future_steps=10):
-    res= []
-    masks = []
-    for i in range(egos.shape[0]):
-        line = egos[i:i+future_steps]
-        mask = [1]*line.shape[0] + [0]*(future_steps-line.shape[0])
-        if line.shape[0]<future_steps:
-            zeros = np.zeros((future_steps-line.shape[0],line.shape[-1]))
-            line = np.concatenate((line,zeros),axis=0)
-        
-        res.append(line)
-        masks.append(mask)
-    
-    return np.array(res) , np.array(masks)
+    n = egos.shape[0]
+    # zero rows past the end so every start index has a full window
+    padded = np.concatenate((egos,np.zeros((future_steps-1,)+egos.shape[1:])),axis=0)
+    windows = np.lib.stride_tricks.sliding_window_view(padded,future_steps,axis=0)
+    res = np.moveaxis(windows,-1,1).copy()
+
+    lens = np.clip(n-np.arange(n),0,future_steps)
+    masks = (np.arange(future_steps)[None,:]<lens[:,None]).astype(int)
+
+    return res , masks
 
 def test_df():
     data = [8,9,10,11,12,13,14,15,16]
@@ -266,6 +468,7 @@ import numpy as np
 import pickle
 import argparse
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from tqdm import tqdm
 import pickle
 
@@ -307,44 +510,34 @@ def decode_map_xml(path):
 
     # print(len(polys))
     plt.figure(figsize=(10,10))
-    cnt = 0
-    for i,poly in enumerate(polys):
-        p = poly.exterior.coords
-        # for p in poly:
-        x,y = [c[0] for c in p],[c[1] for c in p]
-        # x,y = make_interp(x, y)
-        # print(len(x))
-        # plt.scatter(x[0], y[0],edgecolors='black')
-        h_alpha =  1
-        h_lw = 1.5
-        plt.plot(x,y,'--', color='k', linewidth=h_lw, alpha=h_alpha)
-        # plt.scatter(x,y,s=10)
-        cnt+=len(x)
+    # draw every polygon outline as one collection instead of a plot call each
+    lines = [np.asarray(poly.exterior.coords)[:,:2] for poly in polys]
+    cnt = sum(len(line) for line in lines)
+    h_alpha =  1
+    h_lw = 1.5
+    ax = plt.gca()
+    ax.add_collection(LineCollection(lines, linestyles='--', colors='k', linewidths=h_lw, alpha=h_alpha))
+    ax.autoscale_view()
 
     plt.savefig('./TPDM_transformer/test_maps/test_map_new.png')
     # print(cnt)
     # return plt
 
 def make_interp(x_value,y_value,min_dist=2):
-    interp_x = []
-    interp_y = []
-    for j in range(len(x_value)-1):
-        x_diff = x_value[j+1] - x_value[j]
-        y_diff = y_value[j+1] - y_value[j]
-        dist=np.sqrt(x_diff**2+y_diff**2)
-        if dist<=min_dist:
-            interp_x.append(x_value[j])
-            interp_y.append(y_value[j])
-        else:
-            need_interp_num = dist//min_dist
-            index = np.arange(2+need_interp_num)
-            new_x = np.interp(index,[0,index[-1]],[x_value[j],x_value[j+1]]).tolist()
-            new_y = np.interp(index,[0,index[-1]],[y_value[j],y_value[j+1]]).tolist()
-            interp_x = interp_x + new_x[:-1] #traj.x_value[j+1] doesnot count
-            interp_y = interp_y + new_y[:-1]
-        
-    interp_x.append(x_value[-1])
-    interp_y.append(y_value[-1])
+    x_value = np.asarray(x_value,dtype=np.float64)
+    y_value = np.asarray(y_value,dtype=np.float64)
+    x_diff = np.diff(x_value)
+    y_diff = np.diff(y_value)
+    dist = np.hypot(x_diff,y_diff)
+    # points emitted per segment, traj.x_value[j+1] doesnot count
+    seg_num = np.where(dist<=min_dist,1,dist//min_dist+1).astype(np.int64)
+
+    seg = np.repeat(np.arange(seg_num.shape[0]),seg_num)
+    seg_start = np.cumsum(seg_num) - seg_num
+    t = (np.arange(seg.shape[0]) - seg_start[seg]) / seg_num[seg]
+
+    interp_x = np.append(x_value[seg] + t*x_diff[seg],x_value[-1])
+    interp_y = np.append(y_value[seg] + t*y_diff[seg],y_value[-1])
 
     return interp_x,interp_y
 